@@ -0,0 +1,82 @@
+import threading
+import time
+
+import singer
+from singer import metrics
+
+LOGGER = singer.get_logger()
+
+THROTTLE_STATUS_CODES = (423, 429, 503)
+
+# a response slower than this multiple of the average latency is not
+# counted towards raising the limit
+LATENCY_TOLERANCE = 2.0
+LATENCY_EWMA_ALPHA = 0.2
+
+# throttled responses tend to arrive in bursts; cut at most once per interval
+DECREASE_INTERVAL = 10
+
+
+class AimdController(object):
+    """
+    Additive-increase/multiplicative-decrease limit on the number of report
+    jobs in flight. The limit grows by one after a full limit's worth of
+    healthy report polls and is halved on 423/429/503 or a transport error.
+    """
+    def __init__(self, max_limit, min_limit=1, initial_limit=1, decrease_factor=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.decrease_factor = decrease_factor
+        self.limit = min(max(initial_limit, min_limit), self.max_limit)
+
+        self._lock = threading.Lock()
+        self._successes = 0
+        self._latency = None
+        self._last_decrease = None
+
+    def on_response(self, status_code):
+        """Any API response: throttles cut the limit, other 5xx hold it."""
+        with self._lock:
+            if status_code in THROTTLE_STATUS_CODES:
+                self._decrease('throttled_{}'.format(status_code))
+            elif status_code >= 500:
+                self._successes = 0
+
+    def on_transport_error(self):
+        """A timeout or dropped connection is treated like a throttle."""
+        with self._lock:
+            self._decrease('transport_error')
+
+    def on_report_poll(self, latency):
+        """
+        A successful report poll. Only these feed the latency average, so
+        the health check compares like with like.
+        """
+        with self._lock:
+            healthy = self._latency is None or latency <= LATENCY_TOLERANCE * self._latency
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += LATENCY_EWMA_ALPHA * (latency - self._latency)
+
+            if not healthy:
+                self._successes = 0
+                return
+
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_limit:
+                self._set_limit(self.limit + 1, 'increase')
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < DECREASE_INTERVAL:
+            return
+        self._last_decrease = now
+        self._set_limit(max(int(self.limit * self.decrease_factor), self.min_limit), reason)
+
+    def _set_limit(self, limit, reason):
+        self._successes = 0
+        if limit == self.limit:
+            return
+        self.limit = limit
+        metrics.log(LOGGER, metrics.Point('gauge', 'report_jobs_limit', limit, {'reason': reason}))
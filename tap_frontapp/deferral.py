@@ -0,0 +1,33 @@
+import heapq
+import itertools
+import time
+
+
+class DeferralQueue(object):
+    """
+    Jobs ordered by the time they may next run. A throttled job is pushed
+    back with a delay instead of sleeping, so other ready jobs keep going.
+    """
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, job, delay=0):
+        now = time.monotonic()
+        heapq.heappush(self._heap, (now + delay, next(self._counter), now, job))
+
+    def pop(self):
+        """
+        Return the earliest job and the seconds it spent in the queue,
+        sleeping until it is ready if need be. Returns (None, 0) when empty.
+        """
+        if not self._heap:
+            return None, 0
+        wait = self._heap[0][0] - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _, _, pushed_at, job = heapq.heappop(self._heap)
+        return job, time.monotonic() - pushed_at
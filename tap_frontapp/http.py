@@ -1,24 +1,75 @@
 import json
+import queue
+import threading
 import time
+from collections import deque
 
 import requests
 import backoff
 import singer
 from singer import metrics
 
+from .concurrency import AimdController
+
 RETRY_RATE_LIMIT = 60
 
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_REQUEST_DEADLINE = 900
+MAX_TRANSIENT_TRIES = 3
+
+DEFAULT_HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
+HEDGE_LATENCY_WINDOW = 100
+# hedges are extra API calls the client-side limiter never sees, so at most
+# this share of report polls may be duplicated, and none once Front reports
+# fewer than HEDGE_MIN_CALLS_REMAINING calls left in the current window
+HEDGE_BUDGET_RATIO = 0.05
+HEDGE_MIN_CALLS_REMAINING = 10
+
+DEFAULT_MAX_REPORT_JOBS = 8
+
 LOGGER = singer.get_logger()
 
 
-class RateLimitException(Exception):
+class ThrottledException(Exception):
+    """Front asked us to slow down; retry_after is the suggested wait in seconds."""
+    def __init__(self, message='', retry_after=RETRY_RATE_LIMIT, response=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.response = response
+
+
+class RateLimitException(ThrottledException):
     pass
 
 
-class MetricsRateLimitException(Exception):
+class MetricsRateLimitException(ThrottledException):
     pass
 
 
+def _retry_after(response):
+    try:
+        return int(float(response.headers.get("retry-after", RETRY_RATE_LIMIT)))
+    except (TypeError, ValueError):
+        return RETRY_RATE_LIMIT
+
+
+def _config_number(config, key, default):
+    """
+    Read a positive number from the config, falling back to the default
+    when it is missing, empty or zero.
+    """
+    value = config.get(key)
+    if value in (None, '') or float(value) <= 0:
+        return default
+    return float(value)
+
+
+def _config_flag(config, key):
+    return str(config.get(key, False)).lower() == 'true'
+
+
 class Client(object):
     BASE_URL = 'https://api2.frontapp.com'
 
@@ -30,6 +81,20 @@ class Client(object):
         self.limit_reset = None
         self._retry_after = RETRY_RATE_LIMIT
 
+        self.connect_timeout = _config_number(config, 'connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        self.read_timeout = _config_number(config, 'request_timeout', DEFAULT_READ_TIMEOUT)
+        self.request_deadline = _config_number(config, 'request_deadline', DEFAULT_REQUEST_DEADLINE)
+
+        self.hedge_report_polls = _config_flag(config, 'hedge_report_polls')
+        self.hedge_percentile = _config_number(config, 'hedge_percentile', DEFAULT_HEDGE_PERCENTILE)
+        self._poll_latencies = deque(maxlen=HEDGE_LATENCY_WINDOW)
+        self._hedged_polls = 0
+        self._hedges = 0
+
+        # in-flight report job limit, adjusted from the responses we see
+        self.report_jobs = AimdController(
+            max_limit=int(_config_number(config, 'max_report_jobs', DEFAULT_MAX_REPORT_JOBS)))
+
     def url(self, path):
         return self.BASE_URL + path
 
@@ -41,17 +106,53 @@ class Client(object):
         while True:
             yield self._retry_after
 
-    def request(self, method, url, **kwargs):
+    def _record_response(self, response):
+        self.report_jobs.on_response(response.status_code)
+        self.calls_remaining = int(response.headers['X-Ratelimit-Remaining'])
+        self.limit_reset = int(float(response.headers['X-Ratelimit-Reset']))
+
+    def request(self, method, url, defer_rate_limits=False, record_state=True, **kwargs):
+        # With defer_rate_limits the caller schedules its own retry, so a
+        # throttled response is raised straight away instead of sleeping.
+        # With record_state=False the rate limit headers and the outcome
+        # are left for the caller to record; hedged polls use this so only
+        # the request whose result is used updates the client.
+
+        # Every call, including its retries, has to finish within
+        # request_deadline seconds; both backoff decorators read the
+        # remaining budget when they start.
+        deadline = time.monotonic() + self.request_deadline
+
+        def _remaining():
+            return max(deadline - time.monotonic(), 0)
+
+        # only GETs are safe to resend after a read timeout or dropped
+        # connection; anything else is retried only if it never connected
+        def _not_retryable(error):
+            return method.lower() != 'get' and \
+                not isinstance(error, requests.exceptions.ConnectTimeout)
+
         @backoff.on_exception(
             self._rate_limit_backoff,
             RateLimitException,
-            max_tries=2,
+            max_tries=1 if defer_rate_limits else 2,
+            max_time=_remaining,
             jitter=None,
         )
+        @backoff.on_exception(
+            backoff.expo,
+            (requests.exceptions.Timeout, requests.exceptions.ConnectionError),
+            max_tries=MAX_TRANSIENT_TRIES,
+            max_time=_remaining,
+            giveup=_not_retryable,
+        )
         def _call():
             if self.calls_remaining is not None and self.calls_remaining == 0:
-                wait = self.limit_reset - int(time.monotonic())
+                # X-Ratelimit-Reset is an epoch timestamp
+                wait = self.limit_reset - int(time.time())
                 if 0 < wait <= 300:
+                    if defer_rate_limits:
+                        raise RateLimitException('Rate limit exhausted', retry_after=wait)
                     time.sleep(wait)
 
             if 'headers' not in kwargs:
@@ -60,30 +161,32 @@ class Client(object):
                 kwargs['headers']['Authorization'] = self.token
 
             kwargs['headers']['Content-Type'] = 'application/json'
+            kwargs['timeout'] = (self.connect_timeout,
+                                 max(min(self.read_timeout, _remaining()), 1))
 
-            if 'endpoint' in kwargs:
-                endpoint = kwargs['endpoint']
-                del kwargs['endpoint']
-                with metrics.http_request_timer(endpoint) as timer:
+            try:
+                if 'endpoint' in kwargs:
+                    endpoint = kwargs['endpoint']
+                    del kwargs['endpoint']
+                    with metrics.http_request_timer(endpoint) as timer:
+                        response = requests.request(method, url, **kwargs)
+                        timer.tags[metrics.Tag.http_status_code] = response.status_code
+                else:
                     response = requests.request(method, url, **kwargs)
-                    timer.tags[metrics.Tag.http_status_code] = response.status_code
-            else:
-                response = requests.request(method, url, **kwargs)
-
-            self.calls_remaining = int(response.headers['X-Ratelimit-Remaining'])
-            self.limit_reset = int(float(response.headers['X-Ratelimit-Reset']))
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                if record_state:
+                    self.report_jobs.on_transport_error()
+                raise
+            if record_state:
+                self._record_response(response)
 
             if response.status_code in [429, 503]:
-                try:
-                    self._retry_after = int(
-                        float(response.headers.get("retry-after", RETRY_RATE_LIMIT))
-                    )
-                except (TypeError, ValueError):
-                    self._retry_after = RETRY_RATE_LIMIT
-
-                raise RateLimitException(response.text)
+                self._retry_after = _retry_after(response)
+                raise RateLimitException(response.text, retry_after=self._retry_after,
+                                         response=response)
             if response.status_code == 423:
-                raise MetricsRateLimitException()
+                raise MetricsRateLimitException(response.text, retry_after=_retry_after(response),
+                                                response=response)
             try:
                 response.raise_for_status()
             except:
@@ -94,8 +197,81 @@ class Client(object):
 
         return _call()
 
-    def get_report_metrics(self, url, **kwargs):
+    def _timed_get(self, url, kwargs):
+        # The hedged requests run concurrently, so each one gets its own
+        # copy of the kwargs and headers that request() mutates.
+        kwargs = dict(kwargs, headers=dict(kwargs.get('headers', {})))
+        start = time.monotonic()
         response = self.request('get', url, **kwargs)
+        self._poll_latencies.append(time.monotonic() - start)
+        return response
+
+    def _hedge_delay(self):
+        """
+        Latency after which a report poll is duplicated: the configured
+        percentile of recent poll latencies, or None until enough samples
+        have been collected.
+        """
+        if len(self._poll_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._poll_latencies)
+        index = int(len(latencies) * self.hedge_percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _can_hedge(self):
+        if self.calls_remaining is not None and self.calls_remaining < HEDGE_MIN_CALLS_REMAINING:
+            return False
+        return self._hedges < HEDGE_BUDGET_RATIO * self._hedged_polls
+
+    def _start_get(self, url, kwargs, results):
+        # daemon threads, so a losing request left waiting on its read
+        # timeout never holds up the tap's exit
+        def _run():
+            try:
+                results.put((self._timed_get(url, dict(kwargs, record_state=False)), None))
+            except Exception as err:
+                results.put((None, err))
+
+        threading.Thread(target=_run, daemon=True).start()
+
+    def _hedged_get(self, url, **kwargs):
+        self._hedged_polls += 1
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._timed_get(url, kwargs)
+
+        results = queue.Queue()
+        self._start_get(url, kwargs, results)
+        try:
+            response, error = results.get(timeout=delay)
+        except queue.Empty:
+            if not self._can_hedge():
+                response, error = results.get()
+            else:
+                self._hedges += 1
+                LOGGER.info('Hedging report poll after %.2f secs: %s', delay, url)
+                self._start_get(url, kwargs, results)
+                response, error = results.get()
+                if error is not None:
+                    response, _ = results.get()
+        # a losing request may still be running; it never touches the
+        # client, only the outcome returned here is recorded
+        if response is not None:
+            self._record_response(response)
+            return response
+        if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            self.report_jobs.on_transport_error()
+        elif getattr(error, 'response', None) is not None:
+            self._record_response(error.response)
+        raise error
+
+    def get_report_metrics(self, url, **kwargs):
+        start = time.monotonic()
+        if self.hedge_report_polls:
+            response = self._hedged_get(url, **kwargs)
+        else:
+            response = self.request('get', url, **kwargs)
+        self.report_jobs.on_report_poll(time.monotonic() - start)
         return response.json().get('metrics', [])
 
     def create_report(self, path, data, **kwargs):
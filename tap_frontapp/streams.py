@@ -8,14 +8,16 @@ import requests
 import singer
 from singer.bookmarks import write_bookmark
 from ratelimit import limits, sleep_and_retry, RateLimitException
-from backoff import on_exception, expo, constant
+from backoff import on_exception, expo
 
-from .http import MetricsRateLimitException
+from .deferral import DeferralQueue
+from .http import ThrottledException
 
 LOGGER = singer.get_logger()
 
 MAX_METRIC_JOB_TIME = 1800
 METRIC_JOB_POLL_SLEEP = 3
+MAX_REPORT_DEFERRALS = 5
 
 FRONT_REPORT_API_AVAILABLE_METRICS = [
     "avg_first_response_time",
@@ -116,12 +118,13 @@ def select_fields(mdata, obj):
     return new_obj
 
 
-@on_exception(constant, MetricsRateLimitException, max_tries=5, interval=60)
+# 423 and 429 responses are not retried here: they raise ThrottledException
+# and sync_metric defers the report in its queue.
 @on_exception(expo, RateLimitException, max_tries=5)
 @sleep_and_retry
 @limits(calls=50, period=61)  # Reference: https://dev.frontapp.com/docs/rate-limiting
 def get_report_metrics(atx, report_url):
-    return atx.client.get_report_metrics(report_url)
+    return atx.client.get_report_metrics(report_url, defer_rate_limits=True)
 
 
 @sleep_and_retry
@@ -143,48 +146,115 @@ def create_report(atx, start_date, end_date, filters):
             raise e
 
 
-def sync_metric(atx, metric_name, start_date, end_date):
-    for metric in atx.client.list_metrics(path=METRIC_API_PATH[metric_name]):
-        metric_id = metric['id']
-        metric_description = metric[METRIC_API_DESCRIPTION_KEY[metric_name]]
-        report_url = create_report(atx, start_date, end_date,
-                                   filters={METRIC_API_FILTER_NAME[metric_name]: [metric_id]})
-        if not report_url:
-            continue
+class ReportJob(object):
+    def __init__(self, report_url, metric_id, metric_description):
+        self.report_url = report_url
+        self.metric_id = metric_id
+        self.metric_description = metric_description
+        self.started = time.monotonic()
+        self.deferrals = 0
+        self.deferred = False
+
+
+def log_report_duration(job, status):
+    # same point job_timer('daily_aggregated_metric') emits, but reports
+    # are interleaved so it cannot wrap a single one
+    singer.metrics.log(LOGGER, singer.metrics.Point(
+        'timer', singer.metrics.Metric.job_duration, time.monotonic() - job.started,
+        {singer.metrics.Tag.job_type: 'daily_aggregated_metric',
+         singer.metrics.Tag.status: status}))
+
+
+def sync_metric(atx, metric_name, start_date, end_date, deadline=None):
+    """
+    Create and poll one report per metric id for the day. Returns False when
+    the run deadline stopped it from creating every report, in which case
+    the day has to be synced again.
+    """
+    complete = True
+    start_date_formatted = datetime.datetime.utcfromtimestamp(start_date).strftime('%Y-%m-%d')
+    queue = DeferralQueue()
+    deferred_jobs = 0
+    pending_metrics = iter(atx.client.list_metrics(path=METRIC_API_PATH[metric_name]))
+
+    with singer.metrics.Counter('report_deferrals', {'endpoint': metric_name}) as deferrals, \
+            singer.metrics.Counter('report_deferral_wait_seconds', {'endpoint': metric_name}) as deferral_wait:
+        while True:
+            # keep up to the client's adaptive limit of reports in flight,
+            # deferred ones included, then poll whichever is ready first.
+            # While any report is waiting out a throttle no new ones are
+            # created; the reports that already exist are polled instead.
+            if complete and out_of_time(deadline):
+                LOGGER.info('max_runtime reached, no new reports for {} {}'.format(metric_name, start_date_formatted))
+                complete = False
+            if complete and not deferred_jobs and len(queue) < atx.client.report_jobs.limit:
+                metric = next(pending_metrics, None)
+                if metric is not None:
+                    metric_id = metric['id']
+                    report_url = create_report(atx, start_date, end_date,
+                                               filters={METRIC_API_FILTER_NAME[metric_name]: [metric_id]})
+                    if report_url:
+                        queue.push(ReportJob(report_url, metric_id,
+                                             metric[METRIC_API_DESCRIPTION_KEY[metric_name]]))
+                    continue
+
+            job, waited = queue.pop()
+            if job is None:
+                break
+            if job.deferred:
+                job.deferred = False
+                deferred_jobs -= 1
+                deferral_wait.increment(waited)
+
+            if (time.monotonic() - job.started) >= MAX_METRIC_JOB_TIME:
+                log_report_duration(job, singer.metrics.Status.failed)
+                raise Exception('Metric job timeout ({} secs)'.format(
+                    MAX_METRIC_JOB_TIME))
+
+            LOGGER.info('Metrics query - report_url: {} start_date: {} end_date: {} {}: {} ({})'.format(
+                job.report_url,
+                start_date,
+                end_date,
+                metric_name,
+                job.metric_id,
+                job.metric_description
+            ))
+            try:
+                report_metrics = get_report_metrics(atx, job.report_url)
+            except ThrottledException as e:
+                if job.deferrals >= MAX_REPORT_DEFERRALS:
+                    log_report_duration(job, singer.metrics.Status.failed)
+                    raise e
+                job.deferrals += 1
+                job.deferred = True
+                deferred_jobs += 1
+                deferrals.increment()
+                LOGGER.info('Throttled, deferring report_url: {} for {} secs (deferral {} of {})'.format(
+                    job.report_url, e.retry_after, job.deferrals, MAX_REPORT_DEFERRALS))
+                queue.push(job, e.retry_after)
+                continue
+            except Exception:
+                log_report_duration(job, singer.metrics.Status.failed)
+                raise
 
-        with singer.metrics.job_timer('daily_aggregated_metric'):
-            start = time.monotonic()
-            start_date_formatted = datetime.datetime.utcfromtimestamp(start_date).strftime('%Y-%m-%d')
             # we've really moved this functionality to the request in the http script
             # so we don't expect that this will actually have to run mult times
-            while True:
-                if (time.monotonic() - start) >= MAX_METRIC_JOB_TIME:
-                    raise Exception('Metric job timeout ({} secs)'.format(
-                        MAX_METRIC_JOB_TIME))
-
-                LOGGER.info('Metrics query - report_url: {} start_date: {} end_date: {} {}: {} ({})'.format(
-                    report_url,
-                    start_date,
-                    end_date,
-                    metric_name,
-                    metric_id,
-                    metric_description
-                ))
-                report_metrics = get_report_metrics(atx, report_url)
-                if report_metrics != '':
-                    break
-                else:
-                    time.sleep(METRIC_JOB_POLL_SLEEP)
-
-        record = {
-            "report_id": report_url.split('/')[-1],
-            "analytics_date": start_date_formatted,
-            "analytics_range": 'daily',
-            "metric_id": metric_id,
-            "metric_description": metric_description,
-            **{report_metric["id"]: report_metric["value"] for report_metric in report_metrics}
-        }
-        write_records(metric_name, [record])
+            if report_metrics == '':
+                queue.push(job, METRIC_JOB_POLL_SLEEP)
+                continue
+
+            record = {
+                "report_id": job.report_url.split('/')[-1],
+                "analytics_date": start_date_formatted,
+                "analytics_range": 'daily',
+                "metric_id": job.metric_id,
+                "metric_description": job.metric_description,
+                **{report_metric["id"]: report_metric["value"] for report_metric in report_metrics}
+            }
+            write_records(metric_name, [record])
+            log_report_duration(job, singer.metrics.Status.succeeded)
+
+    return complete
 
 
 def write_metrics_state(atx, metric, date_to_resume):
@@ -192,10 +262,36 @@ def write_metrics_state(atx, metric, date_to_resume):
     atx.write_state()
 
 
-def sync_metrics(atx, metric_name):
-    bookmark = atx.state.get('bookmarks', {}).get(metric_name, {})
-    LOGGER.info('metric: {} '.format(metric_name))
+def get_backfill_ranges(bookmark):
+    return [[pendulum.parse(start), pendulum.parse(end)]
+            for start, end in bookmark.get('backfill_ranges', [])]
+
+
+def write_backfill_state(atx, metric, backfill_ranges):
+    # each range is [date_to_resume, end_date); finished ranges are dropped
+    # and the key goes away once there is nothing left to backfill
+    bookmark = atx.state.setdefault('bookmarks', {}).setdefault(metric, {})
+    backfill_ranges = [[start, end] for start, end in backfill_ranges if start < end]
+    if backfill_ranges:
+        bookmark['backfill_ranges'] = [[start.to_datetime_string(), end.to_datetime_string()]
+                                       for start, end in backfill_ranges]
+    else:
+        bookmark.pop('backfill_ranges', None)
+    atx.write_state()
+
+
+def get_run_deadline(atx):
+    max_runtime = atx.config.get('max_runtime')
+    if not max_runtime or float(max_runtime) <= 0:
+        return None
+    return time.monotonic() + float(max_runtime)
 
+
+def out_of_time(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def get_date_range(atx):
     # start_date is defaulted in the config file 2018-01-01
     # if there's no default date and it gets set to now, then start_date will have to be
     #   set to the prior business day before we can use it.
@@ -211,29 +307,100 @@ def sync_metrics(atx, metric_name):
     end_date = pendulum.parse(atx.config.get('end_date', e_d))
     LOGGER.info('end_date: {} '.format(end_date))
 
-    # if the state file has a date_to_resume, we use it as it is.
-    # if it doesn't exist, we overwrite by start date
-    s_d = start_date.strftime("%Y-%m-%d %H:%M:%S")
-    last_date = pendulum.parse(bookmark.get('date_to_resume', s_d))
-    LOGGER.info('last_date: {} '.format(last_date))
+    return start_date, end_date
+
 
-    # no real reason to assign this other than the naming
-    # makes better sense once we go into the loop
-    current_date = last_date
+def sync_days(atx, metric_name, current_date, last_date, write_state, deadline=None, until_date=None):
+    """
+    Sync one daily report at a time from current_date through last_date,
+    calling write_state with the next date after each successful day.
+    With until_date instead of last_date, days run up to that exclusive
+    bound and the final one is cut short at it, so ranges that are not a
+    whole number of days are still covered. Returns False when the run
+    deadline stopped it early.
+    """
+    while current_date < until_date if until_date else current_date <= last_date:
+        if out_of_time(deadline):
+            LOGGER.info('max_runtime reached, stopping {} at {}'.format(metric_name, current_date))
+            return False
 
-    while current_date <= end_date:
         next_date = current_date + datetime.timedelta(days=1, hours=0)
+        if until_date:
+            next_date = min(next_date, until_date)
 
         ut_current_date = int(current_date.timestamp())
         LOGGER.info('ut_current_date: {} '.format(ut_current_date))
         ut_next_date = int(next_date.timestamp())
         LOGGER.info('ut_next_date: {} '.format(ut_next_date))
-        sync_metric(atx, metric_name, ut_current_date, ut_next_date)
-        # if the prior sync is successful it will write the date_to_resume bookmark
-        write_metrics_state(atx, metric_name, next_date)
+        if not sync_metric(atx, metric_name, ut_current_date, ut_next_date, deadline):
+            # leave the bookmark on this day so the next run redoes it
+            return False
+        # if the prior sync is successful it will write the bookmark
+        write_state(next_date)
         current_date = next_date
 
+    return True
+
+
+def sync_metrics(atx, metric_name, deadline=None):
+    bookmark = atx.state.get('bookmarks', {}).get(metric_name, {})
+    LOGGER.info('metric: {} '.format(metric_name))
+
+    start_date, end_date = get_date_range(atx)
+
+    # if the state file has a date_to_resume, we use it as it is.
+    # if it doesn't exist, we overwrite by start date
+    s_d = start_date.strftime("%Y-%m-%d %H:%M:%S")
+    last_date = pendulum.parse(bookmark.get('date_to_resume', s_d))
+    LOGGER.info('last_date: {} '.format(last_date))
+
+    # with freshness_days set, a stream that is further behind than that
+    # jumps date_to_resume forward to the most recent freshness_days days
+    # (end_date included) and records the skipped days as a backfill range.
+    freshness_days = int(atx.config.get('freshness_days') or 0)
+    if freshness_days > 0:
+        fresh_date = end_date - datetime.timedelta(days=freshness_days - 1, hours=0)
+        if fresh_date > last_date:
+            LOGGER.info('metric: {} deferring {} - {} to backfill'.format(
+                metric_name, last_date, fresh_date))
+            backfill_ranges = get_backfill_ranges(bookmark)
+            if backfill_ranges and backfill_ranges[-1][1] >= last_date:
+                backfill_ranges[-1][1] = fresh_date
+            else:
+                backfill_ranges.append([last_date, fresh_date])
+            write_bookmark(atx.state, metric_name, 'date_to_resume', fresh_date.to_datetime_string())
+            write_backfill_state(atx, metric_name, backfill_ranges)
+            last_date = fresh_date
+
+    sync_days(atx, metric_name, last_date, end_date,
+              lambda next_date: write_metrics_state(atx, metric_name, next_date),
+              deadline)
+
+
+def backfill_metrics(atx, metric_name, deadline=None):
+    bookmark = atx.state.get('bookmarks', {}).get(metric_name, {})
+    backfill_ranges = get_backfill_ranges(bookmark)
+
+    # newest gap first, it is the one most likely to be looked at
+    while backfill_ranges:
+        backfill_date, backfill_end_date = backfill_ranges[-1]
+        LOGGER.info('metric: {} backfilling {} - {}'.format(metric_name, backfill_date, backfill_end_date))
+
+        def write_state(next_date):
+            backfill_ranges[-1][0] = next_date
+            write_backfill_state(atx, metric_name, backfill_ranges)
+
+        if not sync_days(atx, metric_name, backfill_date, None, write_state, deadline,
+                         until_date=backfill_end_date):
+            return
+        backfill_ranges.pop()
+        write_backfill_state(atx, metric_name, backfill_ranges)
+
 
 def sync_selected_streams(atx):
+    deadline = get_run_deadline(atx)
+    # recent days for every stream come first, backfill uses what is left
+    for selected_stream in atx.selected_stream_ids:
+        sync_metrics(atx, selected_stream, deadline)
     for selected_stream in atx.selected_stream_ids:
-        sync_metrics(atx, selected_stream)
+        backfill_metrics(atx, selected_stream, deadline)
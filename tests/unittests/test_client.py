@@ -2,8 +2,10 @@ import unittest
 from unittest.mock import patch
 import requests
 from tap_frontapp.http import Client, RateLimitException, MetricsRateLimitException
-from requests.exceptions import Timeout, ConnectionError
+from requests.exceptions import Timeout, ConnectionError, ConnectTimeout, ReadTimeout
 import json
+import threading
+import time
 
 
 class MockResponse:
@@ -25,6 +27,9 @@ class MockResponse:
         return self.status_code
 
 
+RATE_LIMIT_HEADERS = {"X-Ratelimit-Remaining": "100", "X-Ratelimit-Reset": "1000"}
+
+
 def get_mock_response(status_code=200, raise_for_status=False, json_data=None, headers=None):
     return MockResponse(status_code, headers=headers, json_data=json_data, raise_for_status=raise_for_status)
 
@@ -64,14 +69,190 @@ class TestFrontAppClient(unittest.TestCase):
         with self.assertRaises(MetricsRateLimitException):
             client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
 
+    @patch("time.sleep")
+    @patch("requests.request")
+    def test_deferred_rate_limit_raises_without_sleeping(self, mock_request, mock_sleep):
+        mock_request.return_value = get_mock_response(
+            status_code=429,
+            headers={"X-Ratelimit-Remaining": "10", "X-Ratelimit-Reset": "999", "retry-after": "12"},
+        )
+        client = Client(config={"token": "test-token"})
+        with self.assertRaises(RateLimitException) as ctx:
+            client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz", defer_rate_limits=True)
+        self.assertEqual(ctx.exception.retry_after, 12)
+        self.assertEqual(mock_request.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    @patch("time.sleep")
+    @patch("requests.request")
+    def test_exhausted_rate_limit_is_deferred_until_reset(self, mock_request, mock_sleep):
+        client = Client(config={"token": "test-token"})
+        client.calls_remaining = 0
+        client.limit_reset = int(time.time()) + 30
+        with self.assertRaises(RateLimitException) as ctx:
+            client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz", defer_rate_limits=True)
+        self.assertIn(ctx.exception.retry_after, (29, 30))
+        mock_request.assert_not_called()
+        mock_sleep.assert_not_called()
+
+    @patch("time.sleep")
     @patch("requests.request", side_effect=Timeout)
-    def test_timeout_handling(self, mock_request):
+    def test_timeout_handling(self, mock_request, mock_sleep):
         client = Client(config={"token": "test-token"})
         with self.assertRaises(Timeout):
             client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
 
+    @patch("time.sleep")
     @patch("requests.request", side_effect=ConnectionError)
-    def test_connection_error_handling(self, mock_request):
+    def test_connection_error_handling(self, mock_request, mock_sleep):
         client = Client(config={"token": "test-token"})
         with self.assertRaises(ConnectionError):
             client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+
+    @patch("requests.request")
+    def test_request_passes_timeouts(self, mock_request):
+        mock_request.return_value = get_mock_response(
+            status_code=200,
+            headers={"X-Ratelimit-Remaining": "100", "X-Ratelimit-Reset": "1000"},
+            json_data={"metrics": []}
+        )
+        client = Client(config={"token": "test-token", "connect_timeout": 5, "request_timeout": "30"})
+        client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(mock_request.call_args[1]["timeout"], (5.0, 30.0))
+
+    @patch("time.sleep")
+    @patch("requests.request", side_effect=Timeout)
+    def test_timeout_retries_are_bounded(self, mock_request, mock_sleep):
+        client = Client(config={"token": "test-token"})
+        with self.assertRaises(Timeout):
+            client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(mock_request.call_count, 3)
+
+    @patch("requests.request")
+    def test_only_report_polls_raise_concurrency_limit(self, mock_request):
+        mock_request.return_value = get_mock_response(
+            status_code=200,
+            headers={"X-Ratelimit-Remaining": "100", "X-Ratelimit-Reset": "1000"},
+            json_data={"metrics": [], "_results": []}
+        )
+        client = Client(config={"token": "test-token"})
+        client.list_metrics("/teams")
+        self.assertEqual(client.report_jobs.limit, 1)
+        client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(client.report_jobs.limit, 2)
+
+    @patch("time.sleep")
+    @patch("requests.request", side_effect=Timeout)
+    def test_timeout_lowers_concurrency_limit(self, mock_request, mock_sleep):
+        client = Client(config={"token": "test-token"})
+        client.report_jobs.limit = 4
+        with self.assertRaises(Timeout):
+            client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(client.report_jobs.limit, 2)
+
+    @patch("time.sleep")
+    @patch("requests.request", side_effect=ReadTimeout)
+    def test_post_read_timeout_is_not_retried(self, mock_request, mock_sleep):
+        client = Client(config={"token": "test-token"})
+        with self.assertRaises(ReadTimeout):
+            client.create_report("/analytics/reports", data={})
+        self.assertEqual(mock_request.call_count, 1)
+
+    @patch("time.sleep")
+    @patch("requests.request", side_effect=ConnectTimeout)
+    def test_post_connect_timeout_is_retried(self, mock_request, mock_sleep):
+        client = Client(config={"token": "test-token"})
+        with self.assertRaises(ConnectTimeout):
+            client.create_report("/analytics/reports", data={})
+        self.assertEqual(mock_request.call_count, 3)
+
+    @patch("time.sleep")
+    @patch("requests.request")
+    def test_rate_limit_retry_respects_deadline(self, mock_request, mock_sleep):
+        mock_request.return_value = get_mock_response(
+            status_code=429,
+            headers={"X-Ratelimit-Remaining": "10", "X-Ratelimit-Reset": "999", "retry-after": "60"},
+        )
+        client = Client(config={"token": "test-token", "request_deadline": 5})
+        with self.assertRaises(RateLimitException):
+            client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertLessEqual(mock_sleep.call_args[0][0], 5)
+
+    def test_hedged_poll_returns_first_response(self):
+        client = Client(config={"token": "test-token", "hedge_report_polls": True})
+        client._poll_latencies.extend([0.01] * 10)
+        calls = []
+
+        def slow_then_fast(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return get_mock_response(json_data={"metrics": [{"id": "slow"}]}, headers=RATE_LIMIT_HEADERS)
+            return get_mock_response(json_data={"metrics": [{"id": "fast"}]}, headers=RATE_LIMIT_HEADERS)
+
+        with patch.object(client, "request", side_effect=slow_then_fast):
+            response = client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(response, [{"id": "fast"}])
+        self.assertEqual(len(calls), 2)
+
+    @patch("time.sleep")
+    @patch("requests.request")
+    def test_losing_hedge_does_not_touch_client_state(self, mock_request, mock_sleep):
+        client = Client(config={"token": "test-token", "hedge_report_polls": True})
+        client._poll_latencies.extend([0.01] * 10)
+        client.report_jobs.limit = 4
+        release = threading.Event()
+        calls = []
+
+        def respond(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                # the primary stalls until the hedge has won, then times out
+                release.wait(5)
+                raise Timeout
+            if len(calls) == 2:
+                return get_mock_response(
+                    headers={"X-Ratelimit-Remaining": "42", "X-Ratelimit-Reset": "1000"},
+                    json_data={"metrics": [{"id": "hedge"}]})
+            return get_mock_response(
+                headers={"X-Ratelimit-Remaining": "1", "X-Ratelimit-Reset": "2000"})
+
+        mock_request.side_effect = respond
+        response = client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(response, [{"id": "hedge"}])
+
+        # let the loser time out, retry and finish on its own thread
+        release.set()
+        for _ in range(100):
+            if len(calls) >= 3:
+                break
+            threading.Event().wait(0.01)
+        threading.Event().wait(0.05)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(client.calls_remaining, 42)
+        self.assertEqual(client.limit_reset, 1000)
+        self.assertEqual(client.report_jobs.limit, 4)
+
+    def test_no_hedging_when_rate_limit_is_low(self):
+        client = Client(config={"token": "test-token", "hedge_report_polls": True})
+        client._poll_latencies.extend([0.01] * 10)
+        client.calls_remaining = 2
+        calls = []
+
+        def slow(method, url, **kwargs):
+            calls.append(url)
+            time.sleep(0.1)
+            return get_mock_response(json_data={"metrics": [{"id": "slow"}]}, headers=RATE_LIMIT_HEADERS)
+
+        with patch.object(client, "request", side_effect=slow):
+            response = client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(response, [{"id": "slow"}])
+        self.assertEqual(len(calls), 1)
+
+    def test_no_hedging_without_latency_samples(self):
+        client = Client(config={"token": "test-token", "hedge_report_polls": "true"})
+        with patch.object(client, "request", return_value=get_mock_response(json_data={"metrics": []})) as mock_request:
+            client.get_report_metrics("https://api2.frontapp.com/analytics/reports/xyz")
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(len(client._poll_latencies), 1)
@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from tap_frontapp.concurrency import AimdController
+
+
+class TestAimdController(unittest.TestCase):
+
+    def test_limit_grows_additively_while_healthy(self):
+        controller = AimdController(max_limit=4)
+        limits = []
+        for _ in range(6):
+            controller.on_report_poll(1.0)
+            limits.append(controller.limit)
+        # +1 after a full limit's worth of healthy responses
+        self.assertEqual(limits, [2, 2, 3, 3, 3, 4])
+
+    def test_limit_is_capped(self):
+        controller = AimdController(max_limit=2)
+        for _ in range(10):
+            controller.on_report_poll(1.0)
+        self.assertEqual(controller.limit, 2)
+
+    def test_slow_responses_do_not_raise_limit(self):
+        controller = AimdController(max_limit=4, initial_limit=2)
+        controller.on_report_poll(1.0)
+        controller.on_report_poll(5.0)
+        self.assertEqual(controller.limit, 2)
+
+    @patch("tap_frontapp.concurrency.time.monotonic")
+    def test_throttling_halves_limit_once_per_interval(self, mock_monotonic):
+        controller = AimdController(max_limit=16, initial_limit=8)
+        mock_monotonic.return_value = 100
+        controller.on_response(423)
+        controller.on_response(429)
+        self.assertEqual(controller.limit, 4)
+
+        mock_monotonic.return_value = 200
+        controller.on_response(503)
+        self.assertEqual(controller.limit, 2)
+
+    def test_limit_never_drops_below_minimum(self):
+        controller = AimdController(max_limit=4)
+        controller.on_response(429)
+        self.assertEqual(controller.limit, 1)
+
+    def test_other_responses_do_not_raise_limit(self):
+        controller = AimdController(max_limit=4)
+        for _ in range(5):
+            controller.on_response(200)
+        self.assertEqual(controller.limit, 1)
+
+    def test_transport_error_halves_limit(self):
+        controller = AimdController(max_limit=8, initial_limit=4)
+        controller.on_transport_error()
+        self.assertEqual(controller.limit, 2)
@@ -0,0 +1,292 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from tap_frontapp import streams
+from tap_frontapp.concurrency import AimdController
+from tap_frontapp.deferral import DeferralQueue
+from tap_frontapp.http import MetricsRateLimitException
+
+
+class MockContext:
+    """Minimal stand-in for tap_frontapp.context.Context."""
+    def __init__(self, config, state=None):
+        self.config = config
+        self.state = state or {}
+        self.selected_stream_ids = {"teams_table"}
+        self.client = MagicMock()
+        self.client.report_jobs = AimdController(max_limit=2, initial_limit=2)
+
+    def write_state(self):
+        pass
+
+
+def synced_dates(mock_sync_metric):
+    return [call[0][2] for call in mock_sync_metric.call_args_list]
+
+
+class TestFreshnessFirstScheduling(unittest.TestCase):
+
+    @patch("tap_frontapp.streams.sync_metric")
+    def test_without_freshness_days_syncs_forward(self, mock_sync_metric):
+        atx = MockContext({"start_date": "2024-01-01 00:00:00", "end_date": "2024-01-03 00:00:00"})
+        streams.sync_selected_streams(atx)
+
+        self.assertEqual(mock_sync_metric.call_count, 3)
+        self.assertEqual(atx.state["bookmarks"]["teams_table"],
+                         {"date_to_resume": "2024-01-04 00:00:00"})
+
+    @patch("tap_frontapp.streams.sync_metric")
+    def test_recent_days_are_synced_before_backfill(self, mock_sync_metric):
+        atx = MockContext({"start_date": "2024-01-01 00:00:00",
+                           "end_date": "2024-01-10 00:00:00",
+                           "freshness_days": 2})
+        streams.sync_selected_streams(atx)
+
+        dates = synced_dates(mock_sync_metric)
+        self.assertEqual(len(dates), 10)
+        # 2024-01-09 and 2024-01-10 first, then 2024-01-01 onwards
+        self.assertEqual(dates[:3], [1704758400, 1704844800, 1704067200])
+        self.assertEqual(atx.state["bookmarks"]["teams_table"],
+                         {"date_to_resume": "2024-01-11 00:00:00"})
+
+    @patch("tap_frontapp.streams.time.monotonic")
+    @patch("tap_frontapp.streams.sync_metric")
+    def test_max_runtime_keeps_backfill_cursor(self, mock_sync_metric, mock_monotonic):
+        # each day consumes 10 seconds of a 25 second budget
+        clock = iter(range(0, 1000, 10))
+        mock_monotonic.side_effect = lambda: next(clock)
+        atx = MockContext({"start_date": "2024-01-01 00:00:00",
+                           "end_date": "2024-01-10 00:00:00",
+                           "freshness_days": 2,
+                           "max_runtime": 25})
+        streams.sync_selected_streams(atx)
+
+        self.assertEqual(mock_sync_metric.call_count, 2)
+        self.assertEqual(atx.state["bookmarks"]["teams_table"],
+                         {"date_to_resume": "2024-01-11 00:00:00",
+                          "backfill_ranges": [["2024-01-01 00:00:00", "2024-01-09 00:00:00"]]})
+
+    @patch("tap_frontapp.streams.sync_metric")
+    def test_resumes_pending_backfill(self, mock_sync_metric):
+        atx = MockContext({"start_date": "2024-01-01 00:00:00",
+                           "end_date": "2024-01-10 00:00:00",
+                           "freshness_days": 2},
+                          {"bookmarks": {"teams_table": {
+                              "date_to_resume": "2024-01-10 00:00:00",
+                              "backfill_ranges": [["2024-01-06 00:00:00", "2024-01-08 00:00:00"]]}}})
+        streams.sync_selected_streams(atx)
+
+        self.assertEqual(synced_dates(mock_sync_metric), [1704844800, 1704499200, 1704585600])
+        self.assertEqual(atx.state["bookmarks"]["teams_table"],
+                         {"date_to_resume": "2024-01-11 00:00:00"})
+
+    @patch("tap_frontapp.streams.sync_metric")
+    def test_new_gap_with_backfill_pending_stays_fresh_first(self, mock_sync_metric):
+        atx = MockContext({"start_date": "2024-01-01 00:00:00",
+                           "end_date": "2024-01-10 00:00:00",
+                           "freshness_days": 2},
+                          {"bookmarks": {"teams_table": {
+                              "date_to_resume": "2024-01-05 00:00:00",
+                              "backfill_ranges": [["2024-01-01 00:00:00", "2024-01-03 00:00:00"]]}}})
+        streams.sync_selected_streams(atx)
+
+        day = 86400
+        jan_1 = 1704067200
+        # the fresh days, then the newest gap, then the older one; 2024-01-03
+        # and 2024-01-04 were already synced and are not repeated
+        self.assertEqual(synced_dates(mock_sync_metric),
+                         [jan_1 + 8 * day, jan_1 + 9 * day,
+                          jan_1 + 4 * day, jan_1 + 5 * day, jan_1 + 6 * day, jan_1 + 7 * day,
+                          jan_1, jan_1 + day])
+        self.assertEqual(atx.state["bookmarks"]["teams_table"],
+                         {"date_to_resume": "2024-01-11 00:00:00"})
+
+    @patch("tap_frontapp.streams.sync_metric")
+    def test_backfill_range_off_midnight_is_covered(self, mock_sync_metric):
+        atx = MockContext({"start_date": "2024-01-01T05:00:00Z",
+                           "end_date": "2024-01-10 00:00:00",
+                           "freshness_days": 2},
+                          {"bookmarks": {"teams_table": {
+                              "backfill_ranges": [["2023-12-01 00:00:00", "2023-12-02 00:00:00"]]}}})
+        streams.sync_selected_streams(atx)
+
+        windows = [call[0][2:4] for call in mock_sync_metric.call_args_list]
+        jan_1_5am = 1704085200
+        day = 86400
+        # two fresh days, then 2024-01-01 05:00 up to the fresh window with the
+        # last day cut short at midnight, then the older range
+        self.assertEqual(len(windows), 2 + 8 + 1)
+        self.assertEqual(windows[2], (jan_1_5am, jan_1_5am + day))
+        self.assertEqual(windows[9], (jan_1_5am + 7 * day, 1704758400))
+        self.assertEqual(windows[10], (1701388800, 1701475200))
+        self.assertEqual(atx.state["bookmarks"]["teams_table"],
+                         {"date_to_resume": "2024-01-11 00:00:00"})
+
+    @patch("tap_frontapp.streams.sync_metric", return_value=False)
+    def test_unfinished_day_is_not_bookmarked(self, mock_sync_metric):
+        atx = MockContext({"start_date": "2024-01-01 00:00:00",
+                           "end_date": "2024-01-03 00:00:00",
+                           "max_runtime": 60})
+        streams.sync_selected_streams(atx)
+
+        self.assertEqual(mock_sync_metric.call_count, 1)
+        self.assertNotIn("bookmarks", atx.state)
+
+
+class TestReportDeferral(unittest.TestCase):
+
+    def setUp(self):
+        self.atx = MockContext({})
+        self.atx.client.list_metrics.return_value = [
+            {"id": "tea_1", "name": "First"},
+            {"id": "tea_2", "name": "Second"},
+        ]
+
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report", side_effect=lambda atx, s, e, filters: "/reports/" + filters["team_ids"][0])
+    @patch("tap_frontapp.streams.get_report_metrics")
+    def test_throttled_report_does_not_block_others(self, mock_get, mock_create, mock_write):
+        polls = []
+
+        def poll(atx, report_url):
+            polls.append(report_url)
+            if polls == ["/reports/tea_1"]:
+                raise MetricsRateLimitException(retry_after=0.2)
+            return [{"id": "num_messages_sent", "value": 1}]
+
+        mock_get.side_effect = poll
+        streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600)
+
+        self.assertEqual(polls, ["/reports/tea_1", "/reports/tea_2", "/reports/tea_1"])
+        written = [call[0][1][0]["metric_id"] for call in mock_write.call_args_list]
+        self.assertEqual(written, ["tea_2", "tea_1"])
+
+    @patch("tap_frontapp.deferral.time.sleep")
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report")
+    @patch("tap_frontapp.streams.get_report_metrics")
+    def test_throttle_cut_caps_reports_in_flight(self, mock_get, mock_create, mock_write, mock_sleep):
+        self.atx.client.list_metrics.return_value = [
+            {"id": "tea_1", "name": "First"},
+            {"id": "tea_2", "name": "Second"},
+            {"id": "tea_3", "name": "Third"},
+        ]
+        controller = self.atx.client.report_jobs
+        events = []
+
+        def create(atx, s, e, filters):
+            events.append("create " + filters["team_ids"][0])
+            return "/reports/" + filters["team_ids"][0]
+
+        def poll(atx, report_url):
+            events.append("poll " + report_url.split("/")[-1])
+            if events.count("poll tea_1") == 1 and report_url.endswith("tea_1"):
+                controller.on_response(423)
+                raise MetricsRateLimitException(retry_after=60)
+            return []
+
+        mock_create.side_effect = create
+        mock_get.side_effect = poll
+        mock_sleep.side_effect = lambda seconds: events.append("sleep")
+
+        streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600)
+
+        # the cut to one leaves no room for tea_3 while tea_1 is deferred
+        self.assertEqual(controller.limit, 1)
+        self.assertEqual(events, ["create tea_1", "create tea_2", "poll tea_1", "poll tea_2",
+                                  "sleep", "poll tea_1", "create tea_3", "poll tea_3"])
+
+    @patch("tap_frontapp.deferral.time.sleep")
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report")
+    @patch("tap_frontapp.streams.get_report_metrics")
+    def test_deferral_polls_existing_reports_instead_of_creating(self, mock_get, mock_create, mock_write, mock_sleep):
+        self.atx.client.list_metrics.return_value = [
+            {"id": "tea_{}".format(i), "name": str(i)} for i in range(1, 6)]
+        self.atx.client.report_jobs = AimdController(max_limit=4, initial_limit=4)
+        events = []
+
+        def create(atx, s, e, filters):
+            events.append("create " + filters["team_ids"][0])
+            return "/reports/" + filters["team_ids"][0]
+
+        def poll(atx, report_url):
+            events.append("poll " + report_url.split("/")[-1])
+            if events.count("poll tea_1") == 1 and report_url.endswith("tea_1"):
+                raise MetricsRateLimitException(retry_after=60)
+            return []
+
+        mock_create.side_effect = create
+        mock_get.side_effect = poll
+        mock_sleep.side_effect = lambda seconds: events.append("sleep")
+
+        streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600)
+
+        # slots free up while tea_1 is deferred, but tea_5 waits for it
+        self.assertEqual(events, ["create tea_1", "create tea_2", "create tea_3", "create tea_4",
+                                  "poll tea_1", "poll tea_2", "poll tea_3", "poll tea_4",
+                                  "sleep", "poll tea_1", "create tea_5", "poll tea_5"])
+
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report", side_effect=lambda atx, s, e, filters: "/reports/" + filters["team_ids"][0])
+    @patch("tap_frontapp.streams.get_report_metrics")
+    def test_in_flight_limit_of_one_is_sequential(self, mock_get, mock_create, mock_write):
+        self.atx.client.report_jobs = AimdController(max_limit=1)
+        calls = []
+        mock_create.side_effect = lambda atx, s, e, filters: calls.append("create") or "/reports/1"
+        mock_get.side_effect = lambda atx, report_url: calls.append("poll") or []
+
+        streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600)
+        self.assertEqual(calls, ["create", "poll", "create", "poll"])
+
+    @patch("tap_frontapp.streams.out_of_time", side_effect=[False, True, True, True])
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report", side_effect=lambda atx, s, e, filters: "/reports/" + filters["team_ids"][0])
+    @patch("tap_frontapp.streams.get_report_metrics", return_value=[])
+    def test_deadline_stops_new_reports(self, mock_get, mock_create, mock_write, mock_out_of_time):
+        complete = streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600, deadline=0)
+
+        self.assertFalse(complete)
+        self.assertEqual(mock_create.call_count, 1)
+        # the report already created is still collected
+        self.assertEqual(mock_write.call_count, 1)
+
+    @patch("tap_frontapp.deferral.time.sleep")
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report", return_value="/reports/1")
+    @patch("tap_frontapp.streams.get_report_metrics", side_effect=MetricsRateLimitException(retry_after=0))
+    def test_deferral_limit_raises(self, mock_get, mock_create, mock_write, mock_sleep):
+        self.atx.client.list_metrics.return_value = [{"id": "tea_1", "name": "First"}]
+        with self.assertRaises(MetricsRateLimitException):
+            streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600)
+        self.assertEqual(mock_get.call_count, streams.MAX_REPORT_DEFERRALS + 1)
+        mock_write.assert_not_called()
+
+    @patch("tap_frontapp.streams.log_report_duration")
+    @patch("tap_frontapp.streams.write_records")
+    @patch("tap_frontapp.streams.create_report", side_effect=lambda atx, s, e, filters: "/reports/" + filters["team_ids"][0])
+    @patch("tap_frontapp.streams.get_report_metrics", return_value=[])
+    def test_each_report_is_timed(self, mock_get, mock_create, mock_write, mock_log_duration):
+        streams.sync_metric(self.atx, "teams_table", 1704067200, 1704153600)
+
+        timed = [(call[0][0].metric_id, call[0][1]) for call in mock_log_duration.call_args_list]
+        self.assertEqual(timed, [("tea_1", "succeeded"), ("tea_2", "succeeded")])
+
+
+class TestDeferralQueue(unittest.TestCase):
+
+    @patch("tap_frontapp.deferral.time.sleep")
+    @patch("tap_frontapp.deferral.time.monotonic")
+    def test_pop_reports_time_spent_waiting(self, mock_monotonic, mock_sleep):
+        queue = DeferralQueue()
+        mock_monotonic.return_value = 100
+        queue.push("late", delay=30)
+        queue.push("early", delay=10)
+
+        mock_monotonic.side_effect = [104, 110]
+        self.assertEqual(queue.pop(), ("early", 10))
+        mock_sleep.assert_called_once_with(6)
+
+        mock_monotonic.side_effect = [135, 135]
+        self.assertEqual(queue.pop(), ("late", 35))
+        self.assertEqual(queue.pop(), (None, 0))